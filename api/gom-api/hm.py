@@ -205,6 +205,15 @@ async def csv_to_json_pandas(
             detail=f"Erro na conversão: {str(e)}"
         )
 
+def colunas_para_registros(df: pd.DataFrame, cols: List[str]) -> List[Dict[str, float]]:
+    """
+    Um dicionário por linha com as colunas pedidas como float (NaN vira 0.0)
+    """
+    if not cols:
+        # to_dict('records') de um DataFrame sem colunas não devolve uma entrada por linha
+        return [{} for _ in range(len(df))]
+    return df[cols].astype(float).fillna(0.0).to_dict('records')
+
 def processar_com_pandas(df: pd.DataFrame, num_k: int, internal_vars_string: Optional[str]) -> Dict[str, Any]:
     """
     Processa os dados usando pandas
@@ -219,33 +228,34 @@ def processar_com_pandas(df: pd.DataFrame, num_k: int, internal_vars_string: Opt
     
     # Estruturar por variável
     variaveis = {}
+
+    # Colunas k e percentuais LJ são as mesmas para todas as linhas
+    k_cols = [col for col in df.columns if col.startswith('k') and not col.endswith('_perc_lj')]
+    perc_cols = [col for col in df.columns if col.endswith('_perc_lj')]
     
     for var_name in df['Variable'].unique():
         var_data = df[df['Variable'] == var_name]
         
-        levels_data = []
-        for _, row in var_data.iterrows():
-            level_info = {
-                "level": row['Level'],
-                "n": float(row['n']),
-                "perc": float(row['perc']),
-                "valores_k": {},
-                "percentuais_lj": {}
+        # Converte as colunas inteiras de uma vez, sem iterrows por linha
+        valores_k = colunas_para_registros(var_data, k_cols)
+        percentuais_lj = colunas_para_registros(var_data, perc_cols)
+        
+        levels_data = [
+            {
+                "level": level,
+                "n": n,
+                "perc": perc,
+                "valores_k": vk,
+                "percentuais_lj": pl
             }
-            
-            # Extrair colunas k
-            k_cols = [col for col in df.columns if col.startswith('k') and not col.endswith('_perc_lj')]
-            for col in k_cols:
-                if col in row:
-                    level_info["valores_k"][col] = float(row[col]) if pd.notna(row[col]) else 0.0
-            
-            # Extrair percentuais LJ
-            perc_cols = [col for col in df.columns if col.endswith('_perc_lj')]
-            for col in perc_cols:
-                if col in row:
-                    level_info["percentuais_lj"][col] = float(row[col]) if pd.notna(row[col]) else 0.0
-            
-            levels_data.append(level_info)
+            for level, n, perc, vk, pl in zip(
+                var_data['Level'].tolist(),
+                var_data['n'].astype(float).tolist(),
+                var_data['perc'].astype(float).tolist(),
+                valores_k,
+                percentuais_lj
+            )
+        ]
         
         variaveis[var_name] = {
             "nome": var_name,
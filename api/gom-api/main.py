@@ -1,16 +1,43 @@
-import subprocess
+import asyncio
+import codecs
+import csv
+import hashlib
+import logging
 import os
+import shutil
 import tempfile
-import json
-from io import StringIO
-from fastapi import FastAPI, Request, UploadFile, File, Form, HTTPException
-from typing import List, Optional
+from fastapi import FastAPI, Response, UploadFile, File, Form, HTTPException
+from collections import OrderedDict
+from contextlib import AsyncExitStack, asynccontextmanager
+from functools import lru_cache
+from typing import BinaryIO, List, Optional, Tuple
+import numpy as np
 import pandas as pd
-import re
+import pyarrow as pa
+from pyarrow import feather
 from fastapi.middleware.cors import CORSMiddleware
-import requests
+from starlette.concurrency import run_in_threadpool
+import orjson
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Sobe os workers R e o pool de diretórios temporários e os encerra no shutdown
+    """
+    global R_LE_ARROW
+    R_LE_ARROW = await verificar_arrow_r()
+    await iniciar_workers_r()
+    criar_diretorios_temp()
+    try:
+        yield
+    finally:
+        await encerrar_workers_r()
+        remover_diretorios_temp()
+
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
+
+logger = logging.getLogger(__name__)
 
 
 origins = [
@@ -26,17 +53,339 @@ app.add_middleware(
     allow_headers=["*"],    # libera todos os headers
 )
 
-def desconcatena_vars(string_vars: Optional[str]) -> List[str]:
+# Workers R de longa duração (GomRccp_API.R --server) que atendem os uploads
+# O número de vagas na fila é o limite de modelos rodando ao mesmo tempo; cada
+# worker só é criado no primeiro job que pega a vaga, já que carregar o GoMRcpp.R
+# compila C++ e cada interpretador fica residente. Jobs com o mesmo K rodam em série
+# de qualquer forma (travar_perfis), seja qual for o R_CONCURRENCY
+# Com 0 a fila ficaria vazia e todo upload esperaria para sempre por um worker
+R_WORKERS = max(1, int(os.getenv("R_CONCURRENCY", os.cpu_count() or 2)))
+R_RESPOSTA_PREFIXO = b"@@GOM@@ "
+_r_workers: Optional[asyncio.Queue] = None
+# Se o R tem o pacote arrow; sem ele os dados limpos vão como CSV
+R_LE_ARROW = False
+# Todos os workers vivos, inclusive os emprestados a um job, para o shutdown
+_r_processos: set = set()
+
+
+async def _iniciar_worker_r() -> asyncio.subprocess.Process:
+    proc = await asyncio.create_subprocess_exec(
+        "Rscript", "GomRccp_API.R", "--server",
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        limit=1 << 20,
+    )
+    _r_processos.add(proc)
+    return proc
+
+
+async def verificar_arrow_r() -> bool:
+    """
+    Verifica uma única vez se o R consegue carregar o pacote arrow
+    """
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            "Rscript", "-e", 'quit(status = if (requireNamespace("arrow", quietly = TRUE)) 0 else 1)',
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.DEVNULL,
+        )
+    except OSError:
+        return False
+    return await proc.wait() == 0
+
+
+async def iniciar_workers_r():
+    global _r_workers
+    _r_workers = asyncio.Queue()
+    for _ in range(R_WORKERS):
+        # Vaga vazia: executar_job_r cria o worker quando precisar dele
+        _r_workers.put_nowait(None)
+
+
+async def encerrar_workers_r():
+    ociosos = set()
+    while not _r_workers.empty():
+        ociosos.add(_r_workers.get_nowait())
+
+    for proc in list(_r_processos):
+        if proc.returncode is None:
+            if proc in ociosos:
+                # Fechar o stdin encerra o loop do worker
+                proc.stdin.close()
+            else:
+                # Ainda rodando um job: não há resposta para esperar
+                proc.kill()
+        await proc.wait()
+    _r_processos.clear()
+
+
+async def executar_job_r(job: dict) -> dict:
+    """
+    Envia um job para um worker R livre e aguarda a linha de resposta
+    A fila limita quantos modelos rodam ao mesmo tempo ao número de workers
+    """
+    proc = await _r_workers.get()
+    try:
+        if proc is None or proc.returncode is not None:
+            _r_processos.discard(proc)
+            proc = await _iniciar_worker_r()
+
+        proc.stdin.write(orjson.dumps(job) + b"\n")
+        await proc.stdin.drain()
+
+        # O worker desvia o log do GoMRcpp; o prefixo protege contra qualquer outra saída
+        while True:
+            line = await proc.stdout.readline()
+            if not line:
+                raise RuntimeError("O worker R foi encerrado inesperadamente.")
+            if line.startswith(R_RESPOSTA_PREFIXO):
+                return orjson.loads(line[len(R_RESPOSTA_PREFIXO):])
+    except BaseException:
+        # Erro ou cancelamento no meio de um job deixa o worker em estado desconhecido
+        if proc is not None and proc.returncode is None:
+            proc.kill()
+            _r_processos.discard(proc)
+            proc = None
+        raise
+    finally:
+        _r_workers.put_nowait(proc)
+
+
+# Os workers compartilham o diretório da API, onde o GoMRcpp grava K<n>/GoMK<n>(nf).TXT e
+# K<n>/LogGoMK<n>(nf).TXT; o nf sai de um "procura o primeiro livre e depois grava"
+# (data.gamma), então dois jobs com o mesmo K ao mesmo tempo podem pegar o mesmo nf e
+# sobrescrever o log que o /conversao-txt lê. Jobs que compartilham algum K rodam em série;
+# com K distintos seguem em paralelo. Os K são espalhados em um número fixo de locks.
+PERFIS_LOCKS = 16
+_perfis_locks = [asyncio.Lock() for _ in range(PERFIS_LOCKS)]
+
+
+@asynccontextmanager
+async def travar_perfis(k_initial: int, k_final: int):
+    """
+    Segura os locks de todos os K do intervalo, sempre na mesma ordem
+    """
+    perfis = range(min(k_initial, k_final), max(k_initial, k_final) + 1)
+    if len(perfis) >= PERFIS_LOCKS:
+        indices = range(PERFIS_LOCKS)
+    else:
+        indices = sorted({k % PERFIS_LOCKS for k in perfis})
+
+    async with AsyncExitStack() as stack:
+        for i in indices:
+            await stack.enter_async_context(_perfis_locks[i])
+        yield
+
+
+# Diretórios temporários reaproveitados entre uploads, em vez de criar e apagar um por requisição
+TEMP_DIRS = 16
+_temp_dirs: Optional[asyncio.Queue] = None
+
+
+def criar_diretorios_temp():
+    global _temp_dirs
+    _temp_dirs = asyncio.Queue()
+    for _ in range(TEMP_DIRS):
+        _temp_dirs.put_nowait(tempfile.mkdtemp(prefix="gom-api-"))
+
+
+def remover_diretorios_temp():
+    while not _temp_dirs.empty():
+        shutil.rmtree(_temp_dirs.get_nowait(), ignore_errors=True)
+
+
+@asynccontextmanager
+async def emprestar_diretorio_temp():
+    """
+    Empresta um diretório do pool e o esvazia antes de devolvê-lo
+    """
+    temp_dir = await _temp_dirs.get()
+    try:
+        yield temp_dir
+    finally:
+        try:
+            for entry in os.scandir(temp_dir):
+                if entry.is_dir(follow_symlinks=False):
+                    shutil.rmtree(entry.path, ignore_errors=True)
+                else:
+                    os.unlink(entry.path)
+        except OSError:
+            # Não deu para esvaziar: troca por um diretório novo
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            temp_dir = tempfile.mkdtemp(prefix="gom-api-")
+        finally:
+            # O diretório sempre volta ao pool; senão os uploads acabariam esperando para sempre
+            _temp_dirs.put_nowait(temp_dir)
+
+
+# Saídas do R já calculadas, por conteúdo do CSV e parâmetros do modelo
+# Reenvios idênticos (comuns enquanto o frontend é ajustado) não voltam ao R
+# O limite vale em entradas e em bytes, já que a saída do R cresce com os padrões do CSV
+RESULTADOS_CACHE = 64
+RESULTADOS_CACHE_BYTES = 64 << 20
+_resultados_r: "OrderedDict[tuple, bytes]" = OrderedDict()
+_resultados_bytes = 0
+
+
+def buscar_resultado(chave: tuple) -> Optional[bytes]:
+    r_output = _resultados_r.get(chave)
+    if r_output is not None:
+        _resultados_r.move_to_end(chave)
+    return r_output
+
+
+def guardar_resultado(chave: tuple, r_output: bytes) -> None:
+    global _resultados_bytes
+    if len(r_output) > RESULTADOS_CACHE_BYTES:
+        return
+
+    anterior = _resultados_r.pop(chave, None)
+    if anterior is not None:
+        _resultados_bytes -= len(anterior)
+    _resultados_r[chave] = r_output
+    _resultados_bytes += len(r_output)
+
+    while len(_resultados_r) > RESULTADOS_CACHE or _resultados_bytes > RESULTADOS_CACHE_BYTES:
+        _, removido = _resultados_r.popitem(last=False)
+        _resultados_bytes -= len(removido)
+
+
+@lru_cache(maxsize=256)
+def desconcatena_vars(string_vars: Optional[str]) -> Tuple[str, ...]:
             """
-            Desconcatena a string de variáveis separadas por vírgula em uma lista
+            Desconcatena a string de variáveis separadas por vírgula em uma tupla
             Remove espaços em branco e entradas vazias
+            O resultado é imutável porque fica em cache para a mesma string
             """
             if not string_vars or not string_vars.strip():
-                return []
+                return ()
             
             vars_list = [var.strip() for var in string_vars.split(",")]
-            vars_list = [var for var in vars_list if var]
-            return vars_list
+            return tuple(var for var in vars_list if var)
+
+
+# Aspas em qualquer posição e espaços/aspas nas bordas do valor
+_ASPAS_E_BORDAS = r"""^[\s"']+|[\s"']+$|["']"""
+
+
+def _para_numerico(coluna: pd.Series) -> pd.Series:
+    # Converte sem lançar exceção e só aceita se nenhum valor novo virou NaN;
+    # "" conta como vazio, como no to_numeric sem coerce
+    convertida = pd.to_numeric(coluna, errors="coerce")
+    vazios = coluna.isna().sum() + (coluna == "").sum()
+    # No backend pyarrow a falha vira NaN e não nulo, então conta na visão float
+    nan = np.isnan(convertida.to_numpy(dtype=float, na_value=np.nan))
+    if nan.sum() == vazios:
+        # Os vazios precisam seguir como nulo (NA no R), não como NaN, que o
+        # factor() do GoMRcpp trataria como mais uma categoria de resposta
+        return convertida.mask(nan)
+    return coluna
+
+
+def limpar_dataframe(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Remove aspas e espaços das bordas dos nomes de colunas e dos valores de texto
+    Converte para numérico as colunas de texto que só contêm números
+    """
+    df.columns = df.columns.str.replace(_ASPAS_E_BORDAS, "", regex=True)
+
+    # Colunas já numéricas não precisam de limpeza
+    texto = df.select_dtypes(exclude="number").columns
+    if len(texto):
+        df[texto] = df[texto].replace(_ASPAS_E_BORDAS, "", regex=True)
+        df[texto] = df[texto].apply(_para_numerico)
+
+    return df
+
+
+def salvar_upload(origem: BinaryIO, csv_path: str) -> str:
+    """
+    Grava o upload em disco em blocos, sem carregar tudo na memória
+    Devolve o sha256 do conteúdo, calculado na mesma passada
+    """
+    digest = hashlib.sha256()
+    with open(csv_path, "wb") as out:
+        while bloco := origem.read(1 << 20):
+            digest.update(bloco)
+            out.write(bloco)
+    return digest.hexdigest()
+
+
+def ler_bytes(path: str) -> bytes:
+    """
+    Lê o conteúdo bruto de um arquivo
+    """
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def ler_colunas_csv(csv_path: str) -> List[str]:
+    """
+    Lê apenas a linha de cabeçalho do CSV
+    Devolve os nomes das colunas limpos como em limpar_dataframe
+    """
+    with open(csv_path, "rb") as f:
+        cabecalho = f.readline().decode("utf-8-sig").rstrip("\r\n")
+
+    # Sem aspas o cabeçalho pode ser separado direto, sem passar pelo pandas
+    if '"' not in cabecalho and "'" not in cabecalho:
+        return [col.strip() for col in cabecalho.split(",")]
+
+    colunas = pd.read_csv(csv_path, nrows=0).columns
+    return colunas.str.replace(_ASPAS_E_BORDAS, "", regex=True).tolist()
+
+
+def _tem_sujeira(bloco: bytes) -> bool:
+    """
+    Aspas ou espaços em volta de um campo: o que limpar_dataframe teria a corrigir
+    Só buscas de substring, que rodam em C; o bloco começa e termina em fim de linha
+    """
+    if b'"' in bloco or b"'" in bloco:
+        return True
+
+    for espaco in (b" ", b"\t"):
+        # Sem nenhum espaço no bloco não há o que procurar nas bordas dos campos
+        if espaco not in bloco:
+            continue
+        if bloco.startswith(espaco) or bloco.rstrip(b"\r\n").endswith(espaco):
+            return True
+        for borda in (espaco + b",", b"," + espaco, espaco + b"\n", espaco + b"\r", b"\n" + espaco):
+            if borda in bloco:
+                return True
+
+    return False
+
+
+def csv_precisa_limpeza(csv_path: str) -> bool:
+    """
+    Percorre o CSV em blocos procurando algo que limpar_dataframe alteraria
+    Um CSV já limpo pode ir direto para o R, sem ser lido pelo pandas
+    Linhas com número de campos diferente do cabeçalho ou bytes que não são UTF-8
+    também vão para o pandas, que responde com os mesmos erros 400 de antes
+    """
+    with open(csv_path, "rb") as f:
+        bloco = f.read(1 << 20)
+        if bloco.startswith(codecs.BOM_UTF8):
+            return True
+
+        # Sem aspas (senão já seria sujeira), os campos de uma linha são as vírgulas + 1
+        n_virgulas = bloco.split(b"\n", 1)[0].count(b",")
+
+        while bloco:
+            # Completa a última linha para nenhum campo ficar cortado entre blocos
+            bloco += f.readline()
+            if _tem_sujeira(bloco):
+                return True
+            # Linhas em branco são ignoradas pelo pandas e pelo read.csv
+            if any(linha.count(b",") != n_virgulas for linha in bloco.split(b"\n") if linha.strip(b"\r")):
+                return True
+            try:
+                bloco.decode("utf-8")
+            except UnicodeDecodeError:
+                return True
+            bloco = f.read(1 << 20)
+
+    return False
 
 
 @app.get("/")
@@ -44,6 +393,46 @@ async def home():
     return {"message": "Bem-vindo à sua API. Use o endpoint /upload-data/ para enviar seus dados."}
 
 
+def preparar_entrada_r(csv_path: str, temp_dir: str, usar_arrow: bool) -> str:
+    """
+    Devolve o caminho do arquivo que o R deve ler
+    Só passa pelo pandas se houver algo a limpar; senão o upload vai como está
+    """
+    if not csv_precisa_limpeza(csv_path):
+        return csv_path
+
+    # O parser já tira as aspas e os espaços iniciais; campos numéricos
+    # chegam tipados e limpar_dataframe só trata o que sobrar nos textos
+    df = pd.read_csv(csv_path, skipinitialspace=True, quotechar='"', dtype_backend="pyarrow")
+
+    df = limpar_dataframe(df)
+
+    if not usar_arrow:
+        # Os valores limpos já não têm aspas; só campos com vírgula ou quebra de linha são citados
+        df.to_csv(csv_path, index=False, quoting=csv.QUOTE_MINIMAL)
+        return csv_path
+
+    # Entrega ao R os buffers Arrow do DataFrame limpo em vez de outro CSV
+    arrow_path = os.path.join(temp_dir, "in.arrow")
+    feather.write_feather(df, arrow_path)
+    return arrow_path
+
+
+def resposta_upload(file_name: Optional[str], r_output: bytes) -> Response:
+    """
+    Monta a resposta do upload com a saída do R
+    O JSON do R já está pronto: é encaixado no envelope sem decodificar e recodificar
+    """
+    envelope = orjson.dumps({
+        "status": "sucesso",
+        "message": "Dados processados com sucesso!",
+        "file_name": file_name
+    })
+    body = envelope[:-1] + b',"r_output":' + r_output + b"}"
+
+    return Response(content=body, media_type="application/json")
+
+
 @app.post("/upload-data/")
 async def processar_dados(
     file: UploadFile = File(...),
@@ -52,108 +441,197 @@ async def processar_dados(
     case_id: str = Form(...),
     internal_vars_string: Optional[str] = Form(None),
 ):
-    if not file.filename.endswith('.csv'):
+    # Só o nome do arquivo, sem diretórios, para não escapar do diretório temporário
+    safe_name = os.path.basename(file.filename or "")
+    if not safe_name.endswith('.csv'):
         raise HTTPException(status_code=400, detail="O arquivo deve ser um CSV.")
         
     try:
-        contents = await file.read()
-        csv_data = StringIO(contents.decode('utf-8'))
-        df = pd.read_csv(csv_data)
+        async with emprestar_diretorio_temp() as temp_dir:
+            csv_path = os.path.join(temp_dir, safe_name)
 
-        def limpar_dataframe(df):
-            df.columns = [col.replace('"', '').replace("'", "").strip() for col in df.columns]
-            
-           
-            for col in df.columns:
-                # Converte para string e remove aspas
-                df[col] = df[col].astype(str).str.replace('"', '').str.replace("'", "").str.strip()
-                
-                # Tenta converter para numérico onde possível
-                try:
-                    df[col] = pd.to_numeric(df[col])
-                except (ValueError, TypeError):
-                    pass
-            
-            return df
+            digest = await run_in_threadpool(salvar_upload, file.file, csv_path)
 
-        
-        df = limpar_dataframe(df)
+            internal_vars = desconcatena_vars(internal_vars_string)
+            internal_vars_str = ",".join(internal_vars) if internal_vars else ""
 
-        if case_id not in df.columns:
-            raise HTTPException(
-                status_code=400, 
-                detail=f"O CSV não contém a coluna '{case_id}'. Colunas disponíveis: {list(df.columns)}"
-            )
-        
-        internal_vars = desconcatena_vars(internal_vars_string)
+            # Valida as colunas só pelo cabeçalho, antes de ler o corpo do arquivo
+            colunas = await run_in_threadpool(ler_colunas_csv, csv_path)
+            # A lista fica para as mensagens; as buscas usam o conjunto
+            cols = set(colunas)
 
-        if internal_vars:
-            missing_vars = [var for var in internal_vars if var not in df.columns]
-            print(f"Variáveis para validação: {internal_vars}")
-            print(f"Colunas disponíveis no CSV: {list(df.columns)}")
-            
-            if missing_vars:
+            if case_id not in cols:
                 raise HTTPException(
-                    status_code=400,
-                    detail=f"Variáveis não encontradas no CSV: {', '.join(missing_vars)}. Colunas disponíveis: {list(df.columns)}"
+                    status_code=400, 
+                    detail=f"O CSV não contém a coluna '{case_id}'. Colunas disponíveis: {colunas}"
                 )
 
-        with tempfile.TemporaryDirectory() as temp_dir:
-            csv_path = os.path.join(temp_dir, file.filename)
+            if internal_vars:
+                missing_vars = [var for var in internal_vars if var not in cols]
+                logger.debug("Variáveis para validação: %s", internal_vars)
+                logger.debug("Colunas disponíveis no CSV: %s", colunas)
+                
+                if missing_vars:
+                    raise HTTPException(
+                        status_code=400,
+                        detail=f"Variáveis não encontradas no CSV: {', '.join(missing_vars)}. Colunas disponíveis: {colunas}"
+                    )
 
-            # Salva o arquivo CSV limpo
-            df.to_csv(csv_path, index=False)
-        
+            # Tupla, e não string: nomes de colunas podem conter qualquer separador
+            chave = (digest, k_initial, k_final, case_id, internal_vars)
+            r_output = buscar_resultado(chave)
+            if r_output is not None:
+                return resposta_upload(file.filename, r_output)
+
+            # Leitura e limpeza são CPU; rodam no threadpool para não travar o event loop
+            csv_path = await run_in_threadpool(preparar_entrada_r, csv_path, temp_dir, R_LE_ARROW)
 
             output_file_path = os.path.join(temp_dir, "model_output.json")
-            internal_vars_str = ",".join(internal_vars) if internal_vars else ""
 
-            cmd_args = [
-                "Rscript",
-                "GomRccp_API.R",
-                "--file-path", csv_path,
-                "--k-initial", str(k_initial),
-                "--k-final", str(k_final),
-                "--case-id", case_id,
-                "--output-path", output_file_path
-            ]
+            job = {
+                "file-path": csv_path,
+                "k-initial": str(k_initial),
+                "k-final": str(k_final),
+                "case-id": case_id,
+                "output-path": output_file_path
+            }
 
             if internal_vars_str:
-                cmd_args.extend(["--internal-vars", internal_vars_str])
+                job["internal-vars"] = internal_vars_str
 
-            result = subprocess.run(cmd_args, capture_output=True, text=True)
+            async with travar_perfis(k_initial, k_final):
+                resposta = await executar_job_r(job)
 
-            if result.returncode != 0:
+            if resposta.get("status") != "ok":
                 raise HTTPException(
                     status_code=500,
                     detail={
                         "erro": "Falha ao executar script R",
-                        "stdout": result.stdout,
-                        "stderr": result.stderr,
-                        "cmd": " ".join(cmd_args)
+                        "mensagem": resposta.get("mensagem"),
+                        "job": job
                     }
                 )
 
             if not os.path.exists(output_file_path):
                 raise HTTPException(status_code=500, detail="O script R não gerou o arquivo de saída.")
 
-            with open(output_file_path, "r") as f:
-                r_output = json.load(f)
+            r_output = await run_in_threadpool(ler_bytes, output_file_path)
 
-            return {
-                "status": "sucesso",
-                "message": "Dados processados com sucesso!",
-                "file_name": file.filename,
-                "r_output": r_output
-            }
+            if not r_output.strip():
+                raise HTTPException(status_code=500, detail="O script R gerou um arquivo de saída vazio.")
+
+            guardar_resultado(chave, r_output)
 
-    except pd.errors.ParserError:
+            return resposta_upload(file.filename, r_output)
+
+    except (pd.errors.ParserError, pa.lib.ArrowInvalid):
         raise HTTPException(status_code=400, detail="Arquivo CSV mal formatado.")
     except UnicodeDecodeError:
         raise HTTPException(status_code=400, detail="Problema de decodificação do CSV.")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Erro inesperado: {str(e)}")
 
+
+def versao_arquivo(path: str) -> Tuple[int, int]:
+    """
+    Identifica a versão de um arquivo em disco para as chaves de cache
+    O tamanho cobre reescritas dentro da resolução do mtime
+    """
+    st = os.stat(path)
+    return st.st_mtime_ns, st.st_size
+
+
+# Layout da tabela LMFR de cada log do GoM, por número de perfis K
+LMFR_SCHEMA = {
+    2: {
+        "path": "K2/LogGoMK2(1).TXT",
+        "cols": ["Variable", "Level", "n", "perc", "k1", "k2", "k1_perc_lj", "k2_perc_lj"],
+        "n_fields": 7,
+    },
+    3: {
+        "path": "K3/LogGoMK3(1).TXT",
+        "cols": ["Variable", "Level", "n", "perc", "k1", "k2", "k3", "k1_perc_lj", "k2_perc_lj", "k3_perc_lj"],
+        "n_fields": 9,
+    },
+    4: {
+        "path": "K4/LogGoMK4(1).TXT",
+        "cols": ["Variable", "Level", "n", "perc", "k1", "k2", "k3", "k4", "k1_perc_lj", "k2_perc_lj", "k3_perc_lj", "k4_perc_lj"],
+        "n_fields": 11,
+    },
+}
+
+
+@lru_cache(maxsize=32)
+def _parse_lmfr(file_path: str, num_k: int, internal_vars: Tuple[str, ...], versao: Tuple[int, int]) -> pd.DataFrame:
+    """
+    Extrai a tabela LMFR do log TXT do GoM
+    A versão do arquivo (mtime em ns, tamanho) faz parte da chave do cache,
+    então reescrever o TXT invalida o resultado
+    """
+    # Uma única passada pelo arquivo: o mesmo iterador acha o título e depois lê a tabela
+    with open(file_path, "r", encoding="utf-8", errors="ignore") as f:
+        for line in f:
+            if "Lambda-Marginal Frequency Ratio (LMFR)" in line:
+                break
+        else:
+            raise HTTPException(status_code=400, detail="Tabela LMFR não encontrada no arquivo.")
+
+        # Descarta a linha do cabeçalho das colunas
+        next(f, None)
+
+        table_lines = []
+        blank_count = 0
+        for line in f:
+            line_stripped = line.strip()
+            
+            # Critério de parada: dois espaços em branco consecutivos ou linha começando com '*'
+            if not line_stripped:
+                blank_count += 1
+                if blank_count >= 2:
+                    break
+                continue
+            else:
+                blank_count = 0
+                
+            if line_stripped.startswith("*"):
+                break
+                
+            table_lines.append(line_stripped)
+
+    # 3. Tokenização de todas as linhas de uma vez
+    spec = LMFR_SCHEMA[num_k]
+    cols = spec["cols"]
+    n_fields = spec["n_fields"]
+
+    # Só os n_fields + 1 primeiros tokens interessam (nome da variável + campos)
+    tokens = (
+        pd.Series(table_lines, dtype=object)
+        .str.split(n=n_fields + 1, expand=True)
+        .reindex(columns=range(n_fields + 1))
+        .to_numpy(dtype=object)
+    )
+
+    # A linha que abre uma variável interna traz o nome no primeiro token;
+    # as linhas seguintes herdam esse nome e começam direto no nível
+    primeiro = pd.Series(tokens[:, 0], dtype=object)
+    abre_var = primeiro.isin(internal_vars).to_numpy()
+    current_var = primeiro.where(abre_var).ffill().to_numpy()
+
+    campos = np.where(abre_var[:, None], tokens[:, 1:], tokens[:, :n_fields])
+    validas = pd.notna(current_var) & pd.notna(campos[:, -1])
+    campos = campos[validas]
+
+    # 4. Criação do DataFrame coluna a coluna
+    # As colunas numéricas já são convertidas aqui, antes de entrarem no DataFrame
+    frame = {cols[0]: current_var[validas].tolist(), cols[1]: campos[:, 0].tolist()}
+    for i, col in enumerate(cols[2:], start=1):
+        frame[col] = pd.to_numeric(campos[:, i], errors="coerce")
+
+    df = pd.DataFrame(frame, copy=False)
+
+    return df
+
+
 @app.get("/conversao-txt")
 async def transformar_txt(
     num_k: int,
@@ -162,16 +640,11 @@ async def transformar_txt(
    
     internal_vars = desconcatena_vars(internal_vars_string)
 
-    match num_k:
-        case 2: 
-            file_path = "K2/LogGoMK2(1).TXT"
+    spec = LMFR_SCHEMA.get(num_k)
+    if spec is None:
+        raise HTTPException(status_code=400, detail="num_k precisa ser 2, 3 ou 4")
 
-        case 3: 
-            file_path = "K3/LogGoMK3(1).TXT"
-            
-        case 4: 
-            file_path = "K4/LogGoMK4(1).TXT"
-    
+    file_path = spec["path"]
 
     if not os.path.exists(file_path):
         raise HTTPException(status_code=404, detail=f"Arquivo TXT de origem não encontrado no caminho: {file_path}")
@@ -179,107 +652,9 @@ async def transformar_txt(
     output_dir = "csv_results"
     os.makedirs(output_dir, exist_ok=True) 
 
-   
-    with open(file_path, "r", encoding="utf-8", errors="ignore") as f:
-        lines = f.readlines()
-
-    start_idx = None
-    for i, line in enumerate(lines):
-        if "Lambda-Marginal Frequency Ratio (LMFR)" in line:
-            start_idx = i + 2
-            break
-
-    if start_idx is None:
-        raise HTTPException(status_code=400, detail="Tabela LMFR não encontrada no arquivo.")
-
-    
-    table_lines = []
-    blank_count = 0
-    for line in lines[start_idx:]:
-        line_stripped = line.strip()
-        
-        # Critério de parada: dois espaços em branco consecutivos ou linha começando com '*'
-        if not line_stripped:
-            blank_count += 1
-            if blank_count >= 2:
-                break
-            continue
-        else:
-            blank_count = 0
-            
-        if line_stripped.startswith("*"):
-            break
-            
-        table_lines.append(line_stripped)
-
-    # 3. Parsing das Linhas para 'data'
-    data = []
-    current_var = None
-    
-    
-    match num_k:
-        case 2: 
-            cols = ["Variable", "Level", "n", "perc", "k1", "k2", "k1_perc_lj", "k2_perc_lj"]
-
-        case 3: 
-            cols = ["Variable", "Level", "n", "perc", "k1", "k2", "k3", "k1_perc_lj", "k2_perc_lj", "k3_perc_lj"]
-            
-        case 4: 
-            cols = ["Variable", "Level", "n", "perc", "k1", "k2", "k3", "k4", "k1_perc_lj", "k2_perc_lj", "k3_perc_lj", "k4_perc_lj"]
-    
-
-    for line in table_lines:
-        parts = [p for p in re.split(r"\s+", line) if p]
-
-        if not parts:
-            continue
-
-        if parts[0] in internal_vars:
-            print(internal_vars, internal_vars_string)
-            current_var = parts[0]
-            
-            parts = parts[1:]
-        
-        match num_k:
-            case 2:
-                if current_var is not None and len(parts) >= 7:
-                    row_data = parts[:7] 
-                
-                    data.append([current_var] + row_data)
-            case 3:
-                if current_var is not None and len(parts) >= 9:
-                    row_data = parts[:9] 
-                    
-                    data.append([current_var] + row_data)
-            case 4:
-                if current_var is not None and len(parts) >= 11:
-                    row_data = parts[:11] 
-
-                    data.append([current_var] + row_data)
-
-    # 4. Criação do DataFrame
-    try:
-        df = pd.DataFrame(data, columns=cols)
-    except ValueError as e:
-        # Captura o erro específico de número de colunas e fornece mais detalhes
-        if "columns passed, passed data had" in str(e):
-             raise HTTPException(
-                status_code=500, 
-                detail=f"Erro de estrutura de dados: O número de campos extraídos da tabela LMFR ({len(cols)}) não corresponde ao esperado. Log: {e}"
-            )
-        raise
-
-    # 5. Conversão de Tipos
-    match num_k:
-        case 2:
-            for c in ["n", "perc", "k1", "k2", "k1_perc_lj", "k2_perc_lj"]:
-                df[c] = pd.to_numeric(df[c], errors="coerce")
-        case 3:
-            for c in ["n", "perc", "k1", "k2", "k3", "k1_perc_lj", "k2_perc_lj", "k3_perc_lj"]:
-                df[c] = pd.to_numeric(df[c], errors="coerce")
-        case 4:
-            for c in ["n", "perc", "k1", "k2", "k3", "k4", "k1_perc_lj", "k2_perc_lj", "k3_perc_lj", "k4_perc_lj"]:
-                df[c] = pd.to_numeric(df[c], errors="coerce")
+    df = _parse_lmfr(
+        file_path, num_k, tuple(sorted(internal_vars)), versao_arquivo(file_path)
+    )
 
     # 6. Salvamento e Retorno
     output_path = os.path.join(output_dir, "LMFR.csv")
@@ -293,46 +668,53 @@ async def transformar_txt(
         "csv_path": output_path
     }
 
-@app.get("/sunburst-map")
-async def sunburst(num_k: int):
-
-    df = pd.read_csv('csv_results/LMFR3.csv')
+@lru_cache(maxsize=8)
+def _montar_sunburst(csv_path: str, num_k: int, versao: Tuple[int, int]) -> bytes:
+    """
+    Monta a árvore do sunburst a partir do CSV do LMFR, já serializada em JSON
+    Só volta a ler o CSV quando a versão do arquivo muda
+    """
+    df = pd.read_csv(csv_path)
     df.columns = df.columns.str.strip()
 
-    # usa o parâmetro recebido
-    if num_k == 2:
-        headers_k = ["K1", "K2"]
-        percent_k = ["k1_perc_lj", "k2_perc_lj"]
-    elif num_k == 3:
-        headers_k = ["K1", "K2", "K3"]
-        percent_k = ["k1_perc_lj", "k2_perc_lj", "k3_perc_lj"]
-    elif num_k == 4:
-        headers_k = ["K1", "K2", "K3", "K4"]
-        percent_k = ["k1_perc_lj", "k2_perc_lj", "k3_perc_lj", "k4_perc_lj"]
-    else:
-        return {"error": "num_k precisa ser 2, 3 ou 4"}
+    headers_k = [f"K{i}" for i in range(1, num_k + 1)]
+    percent_k = [f"k{i}_perc_lj" for i in range(1, num_k + 1)]
 
     output = []
 
+    # Agrupa uma única vez e lê as colunas inteiras, sem iterrows por linha
+    grupos = [(var, group["Level"].tolist(), group) for var, group in df.groupby("Variable")]
+
     # Monta estrutura JSON
     for k, pk in zip(headers_k, percent_k):
         k_block = {"name": k, "children": []}
         
-        for var, group in df.groupby("Variable"):
-            var_block = {"name": var, "children": []}
-            
-            for _, row in group.iterrows():
-                var_block["children"].append({
-                    "name": row["Level"],
-                    "value": float(row[pk])
-                })
+        for var, levels, group in grupos:
+            values = group[pk].to_numpy(dtype=float).tolist()
+            var_block = {
+                "name": var,
+                "children": [{"name": level, "value": value} for level, value in zip(levels, values)]
+            }
             
             k_block["children"].append(var_block)
         
         output.append(k_block)
 
+    return orjson.dumps(output, option=orjson.OPT_SERIALIZE_NUMPY)
+
+
+@app.get("/sunburst-map")
+async def sunburst(num_k: int):
+
+    # usa o parâmetro recebido
+    if num_k not in (2, 3, 4):
+        return {"error": "num_k precisa ser 2, 3 ou 4"}
+
+    csv_path = 'csv_results/LMFR3.csv'
+
+    body = _montar_sunburst(csv_path, num_k, versao_arquivo(csv_path))
 
-    return output
+    return Response(content=body, media_type="application/json")
 
 
 